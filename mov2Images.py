@@ -19,19 +19,50 @@ Before running the program, ensure you have Python installed on your system. If
 ### Dependencies
 
 This program requires the following dependencies:
-- Dependency1
-- Dependency2
-- Dependency3
+- opencv-python
+- face_recognition (dlib built with CUDA to run the batched CNN face detector on the GPU)
+- numpy
+- The `ffmpeg` and `ffprobe` command line tools on your PATH, used to decode `.mov` videos
+- av (optional): PyAV decodes `.mov` videos in-process instead, without needing the ffmpeg command line tools
 
-You can install these dependencies by running the following command:
+You can install the Python dependencies by running the following command:
 
-`pip install Dependency1 Dependency2 Dependency3`
+`pip install opencv-python face_recognition numpy`
+
+ffmpeg is available from your package manager (e.g. `brew install ffmpeg`, `apt install ffmpeg`) or https://ffmpeg.org.
 '''
 import cv2
+import json
 import os
+import queue
 import random
+import subprocess
+import threading
 import face_recognition
 import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import av
+except ImportError:
+    av = None
+
+# Frames per batched detection call; with the frame queue below, at most about 2 * BATCH_SIZE
+# full-resolution frames are alive at once (~400 MB at 1080p)
+BATCH_SIZE = 32
+SAVE_WORKERS = 16
+# Bounded queues between the decode -> detect -> write stages keep memory flat
+FRAME_QUEUE_SIZE = BATCH_SIZE  # single frames, so decoding can fill the next batch during detection
+WRITE_QUEUE_SIZE = 2 * SAVE_WORKERS  # crops
+QUEUE_POLL_SECONDS = 0.1  # How often blocked pipeline stages check whether another stage failed
+JPEG_PARAMS = [cv2.IMWRITE_JPEG_QUALITY, 92, cv2.IMWRITE_JPEG_OPTIMIZE, 0]
+DEFAULT_FPS = 1
+# Faces in selfie video are large, so detect on a half-size copy and crop from the full frame
+DETECTION_SCALE = 0.5
+LANDMARK_SIZE = 150
+HEAD_TAGS = ('head', 'face')
+# Generic tags used when facial features are not detected
+GENERIC_FEATURE_TAGS = ('face', 'forehead', 'eye_region', 'nose_region', 'mouth_region', 'chin_region')
 
 def random_color():
     return [random.randint(0, 255) for _ in range(3)]
@@ -40,12 +71,14 @@ def resize_and_pad(image, target_size=(512, 512)):
     original_size = image.shape[:2]
     ratio = float(target_size[0]) / max(original_size)
     new_size = tuple([int(x * ratio) for x in original_size])
-    image = cv2.resize(image, (new_size[1], new_size[0]))
-    
+
     pad_h = (target_size[0] - new_size[0]) // 2
     pad_w = (target_size[1] - new_size[1]) // 2
     padding_color = random_color()
-    padded_image = cv2.copyMakeBorder(image, pad_h, pad_h, pad_w, pad_w, cv2.BORDER_CONSTANT, value=padding_color)
+    # Fill the output with the padding color once and copy the resized image into its center
+    padded_image = np.empty((target_size[0], target_size[1], 3), dtype=np.uint8)
+    padded_image[:] = padding_color
+    padded_image[pad_h:pad_h + new_size[0], pad_w:pad_w + new_size[1]] = cv2.resize(image, (new_size[1], new_size[0]))
     return padded_image
 
 def get_head_crop(frame, face_location):
@@ -61,95 +94,293 @@ def get_head_crop(frame, face_location):
     return head_crop
 
 def get_tags_from_landmarks(face_landmarks):
-    feature_tags = []
-    for feature in face_landmarks.keys():
-        feature_tags.append(feature)
-    return feature_tags
+    return list(face_landmarks)
 
-def get_random_face_crop_and_tags(frame, face_locations):
+def downscale_for_landmarks(face_crop):
+    # The shape predictor gains nothing from faces larger than LANDMARK_SIZE pixels
+    scale = LANDMARK_SIZE / max(face_crop.shape[:2])
+    if scale >= 1:
+        return face_crop
+    return cv2.resize(face_crop, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+
+def get_random_face_crop_and_tags(frame, face_locations, detect_landmarks=True):
     if not face_locations:
         return None, [], None, []
 
     face_location = random.choice(face_locations)
     top, right, bottom, left = face_location
 
-    face_crop = frame[top:bottom, left:right]
-    face_landmarks_list = face_recognition.face_landmarks(face_crop)
-    
+    face_crop = np.ascontiguousarray(frame[top:bottom, left:right])
+    face_landmarks_list = []
+    if detect_landmarks:
+        # The crop is the detected face, so pass its own box rather than running detection again
+        landmark_crop = downscale_for_landmarks(face_crop)
+        crop_height, crop_width = landmark_crop.shape[:2]
+        face_landmarks_list = face_recognition.face_landmarks(
+            landmark_crop, face_locations=[(0, crop_width, crop_height, 0)], model="small")
+
     # If facial features are detected, use them to generate tags
     if face_landmarks_list:
         feature_tags = get_tags_from_landmarks(face_landmarks_list[0])
     else:
         # Fallback mechanism to generate generic tags
-        feature_tags = ['face', 'forehead', 'eye_region', 'nose_region', 'mouth_region', 'chin_region']
+        feature_tags = list(GENERIC_FEATURE_TAGS)
 
     entire_head_crop = get_head_crop(frame, face_location)
-    head_tags = ["head", "face"] + feature_tags
+    head_tags = [*HEAD_TAGS, *feature_tags]
 
     return face_crop, feature_tags, entire_head_crop, head_tags
 
-# Input parameters for file path and output directory
-file_path = input("Enter the path to your file (image or video): ")
-output_dir = input("Enter the output directory for the cropped images: ")
-
-# Check and create default output directory if necessary
-if not output_dir:
-    output_dir = "default_output"
-if not os.path.exists(output_dir):
-    os.makedirs(output_dir) 
-
-if os.path.exists(file_path):
-    if file_path.lower().endswith(('.png', '.jpg', '.jpeg')):
-        image = cv2.imread(file_path)
-        if image is None:
-            print(f"Error: Image file '{file_path}' not found.")
-            exit()
-        
-        rgb_image = image[:, :, ::-1]  # Convert to RGB
-        face_locations = face_recognition.face_locations(rgb_image)
-        feature_crop, feature_tags, entire_head_crop, head_tags = get_random_face_crop_and_tags(rgb_image, face_locations)
-
-        if feature_crop is not None and entire_head_crop is not None:
-            if not os.path.exists(output_dir):
-                os.makedirs(output_dir)
-
-            feature_file_path = os.path.join(output_dir, 'feature_crop.png')
-            head_file_path = os.path.join(output_dir, 'head_crop.png')
-            
-            cv2.imwrite(feature_file_path, feature_crop[:, :, ::-1])  # Convert back to BGR
-            cv2.imwrite(head_file_path, entire_head_crop[:, :, ::-1])
-            
-            print(f"Tags for feature crop: {feature_tags}")
-            print(f"Tags for head crop: {head_tags}")
-            print(f"Saved cropped images to {output_dir}")
-        else:
-            print("No face detected in the image.")
-    elif file_path.lower().endswith('.mov'):
-        cap = cv2.VideoCapture(file_path)
-        if not os.path.exists(output_dir):
-            os.makedirs(output_dir)
-
-        frame_count = 0
+def downscale_for_detection(rgb_frame):
+    return cv2.resize(rgb_frame, None, fx=DETECTION_SCALE, fy=DETECTION_SCALE, interpolation=cv2.INTER_AREA)
+
+def upscale_face_locations(face_locations):
+    return [tuple(int(coord / DETECTION_SCALE) for coord in face_location) for face_location in face_locations]
+
+def probe_video(file_path):
+    """
+    Returns the (width, height, clockwise rotation in degrees) of the first video stream using ffprobe.
+    """
+    output = subprocess.check_output([
+        "ffprobe", "-v", "error", "-select_streams", "v:0", "-of", "json",
+        "-show_entries", "stream=width,height:stream_tags=rotate:stream_side_data=rotation", file_path
+    ])
+    stream = json.loads(output)["streams"][0]
+    rotation = int(stream.get("tags", {}).get("rotate", 0))
+    for side_data in stream.get("side_data_list", []):
+        # The display matrix rotation is counterclockwise, unlike the legacy rotate tag
+        rotation = -int(side_data.get("rotation", -rotation))
+    return stream["width"], stream["height"], rotation % 360
+
+def get_video_size(file_path):
+    """
+    Returns the (width, height) of the frames ffmpeg will decode from the first video stream,
+    swapping the dimensions for portrait videos that ffmpeg auto-rotates.
+    """
+    width, height, rotation = probe_video(file_path)
+    if rotation % 180:
+        width, height = height, width
+    return width, height
+
+def decode_frames_pyav(file_path, fps=DEFAULT_FPS):
+    """
+    Yields `fps` upright RGB frames per second of video, decoded in-process with PyAV.
+    """
+    with av.open(file_path) as container:
+        stream = container.streams.video[0]
+        stream.thread_type = 'AUTO'
+        stream.thread_count = os.cpu_count()
+
+        next_time = 0.0
+        for frame in container.decode(stream):
+            if frame.time is not None:
+                if frame.time < next_time:
+                    continue
+                next_time = (int(frame.time * fps) + 1) / fps
+
+            rgb_frame = frame.to_ndarray(format='rgb24')
+            # PyAV does not apply the display matrix, unlike the ffmpeg CLI; its rotation is counterclockwise
+            rotation = getattr(frame, 'rotation', 0)
+            if rotation:
+                rgb_frame = np.ascontiguousarray(np.rot90(rgb_frame, rotation // 90))
+            yield rgb_frame
+
+def decode_frames_ffmpeg(file_path, fps=DEFAULT_FPS):
+    """
+    Yields `fps` RGB frames per second of video, decoded by a single ffmpeg process piping raw frames.
+    """
+    width, height = get_video_size(file_path)
+    frame_size = width * height * 3
+    proc = subprocess.Popen(
+        ["ffmpeg", "-v", "error", "-i", file_path, "-vf", f"fps={fps}", "-f", "rawvideo", "-pix_fmt", "rgb24", "-"],
+        stdout=subprocess.PIPE
+    )
+    try:
         while True:
-            ret, frame = cap.read()
-            if not ret:
+            buf = proc.stdout.read(frame_size)
+            if len(buf) < frame_size:
                 break
 
-            rgb_frame = frame[:, :, ::-1]  # Convert to RGB
-            face_locations = face_recognition.face_locations(rgb_frame)
-            feature_crop, feature_tags, entire_head_crop, head_tags = get_random_face_crop_and_tags(rgb_frame, face_locations)
+            yield np.frombuffer(buf, np.uint8).reshape(height, width, 3)
+    finally:
+        proc.stdout.close()
+        proc.wait()
+
+    # A corrupt or unsupported video otherwise just looks like one without frames
+    if proc.returncode:
+        raise RuntimeError(f"ffmpeg failed to decode '{file_path}' (exit code {proc.returncode})")
+
+def put_unless_stopped(item_queue, item, stop_event):
+    """
+    Puts the item on the queue, giving up if stop_event is set while waiting for space.
+    Returns whether the item was put.
+    """
+    while not stop_event.is_set():
+        try:
+            item_queue.put(item, timeout=QUEUE_POLL_SECONDS)
+            return True
+        except queue.Full:
+            pass
+    return False
+
+def get_unless_stopped(item_queue, stop_event):
+    """
+    Gets an item from the queue, returning None if stop_event is set while waiting for one.
+    """
+    while not stop_event.is_set():
+        try:
+            return item_queue.get(timeout=QUEUE_POLL_SECONDS)
+        except queue.Empty:
+            pass
+    return None
+
+def read_frames(file_path, frame_queue, stop_event, fps=DEFAULT_FPS):
+    """
+    Decodes `fps` frames per second of video, with PyAV when it is installed and the ffmpeg CLI otherwise,
+    and puts them on the queue one RGB frame at a time. A None is put on the queue once the video is exhausted.
+    Stops early when stop_event is set.
+    """
+    decode_frames = decode_frames_pyav if av is not None else decode_frames_ffmpeg
+    try:
+        for rgb_frame in decode_frames(file_path, fps):
+            if not put_unless_stopped(frame_queue, rgb_frame, stop_event):
+                return
+    finally:
+        put_unless_stopped(frame_queue, None, stop_event)
+
+def write_crops(write_queue, stop_event):
+    """
+    Writes (path, RGB image) items from the queue as JPEGs until a None is received or stop_event is set.
+    A failed write sets stop_event so the other stages don't wait on this one.
+    """
+    while True:
+        item = get_unless_stopped(write_queue, stop_event)
+        if item is None:
+            break
+
+        file_path, rgb_image = item
+        try:
+            cv2.imwrite(file_path, cv2.cvtColor(rgb_image, cv2.COLOR_RGB2BGR), JPEG_PARAMS)
+        except BaseException:
+            stop_event.set()
+            raise
+
+def get_frame_batches(frame_queue, stop_event, batch_size=BATCH_SIZE):
+    """
+    Yields lists of up to batch_size RGB frames taken from the queue, until a None is received
+    or stop_event is set.
+    """
+    batch_frames = []
+    while True:
+        rgb_frame = get_unless_stopped(frame_queue, stop_event)
+        if rgb_frame is None:
+            break
+
+        batch_frames.append(rgb_frame)
+        if len(batch_frames) == batch_size:
+            yield batch_frames
+            batch_frames = []
+
+    if batch_frames and not stop_event.is_set():
+        yield batch_frames
+
+def detect_faces(frame_queue, write_queue, stop_event, output_dir, detect_landmarks=True):
+    """
+    Takes RGB frames from the queue until a None is received, detects faces in batches of them
+    and puts the crops to save on the write queue. Returns the number of frames with a face.
+    Stops early when stop_event is set.
+    """
+    frame_count = 0
+    for batch_frames in get_frame_batches(frame_queue, stop_event):
+
+        # Detect faces for the whole batch at once with the CNN model (GPU when dlib has CUDA)
+        small_frames = [downscale_for_detection(rgb_frame) for rgb_frame in batch_frames]
+        locations_per_frame = face_recognition.batch_face_locations(small_frames, number_of_times_to_upsample=0, batch_size=BATCH_SIZE)
+        for rgb_frame, face_locations in zip(batch_frames, locations_per_frame):
+            face_locations = upscale_face_locations(face_locations)
+            feature_crop, feature_tags, entire_head_crop, head_tags = get_random_face_crop_and_tags(rgb_frame, face_locations, detect_landmarks)
 
             if feature_crop is not None and entire_head_crop is not None:
-                feature_file_path = os.path.join(output_dir, f'feature_crop_{frame_count}.png')
-                head_file_path = os.path.join(output_dir, f'head_crop_{frame_count}.png')
-                
-                cv2.imwrite(feature_file_path, feature_crop[:, :, ::-1])  # Convert back to BGR
-                cv2.imwrite(head_file_path, entire_head_crop[:, :, ::-1])
+                feature_file_path = os.path.join(output_dir, f'feature_crop_{frame_count}.jpg')
+                head_file_path = os.path.join(output_dir, f'head_crop_{frame_count}.jpg')
+
+                if not (put_unless_stopped(write_queue, (feature_file_path, feature_crop), stop_event)
+                        and put_unless_stopped(write_queue, (head_file_path, entire_head_crop), stop_event)):
+                    return frame_count
 
                 print(f"Saved {feature_file_path} with tags: {feature_tags}")
                 print(f"Saved {head_file_path} with tags: {head_tags}")
 
                 frame_count += 1
-        cap.release()
-else:
-    print(f"Error: File '{file_path}' not found.")
+    return frame_count
+
+def extract_faces_from_video(file_path, output_dir, fps=DEFAULT_FPS, detect_landmarks=True):
+    """
+    Runs decoding, face detection and writing as a pipeline of concurrent stages connected
+    by bounded queues, so throughput is set by the slowest stage rather than their sum.
+    """
+    frame_queue = queue.Queue(maxsize=FRAME_QUEUE_SIZE)
+    write_queue = queue.Queue(maxsize=WRITE_QUEUE_SIZE)
+    stop_event = threading.Event()
+    with ThreadPoolExecutor(max_workers=1 + SAVE_WORKERS) as executor:
+        reader = executor.submit(read_frames, file_path, frame_queue, stop_event, fps)
+        writers = [executor.submit(write_crops, write_queue, stop_event) for _ in range(SAVE_WORKERS)]
+        try:
+            frame_count = detect_faces(frame_queue, write_queue, stop_event, output_dir, detect_landmarks)
+            # One poison pill per writer
+            for _ in writers:
+                put_unless_stopped(write_queue, None, stop_event)
+        except BaseException:
+            # Unblock the reader and writers, so the executor can shut down and the error is reported
+            stop_event.set()
+            raise
+
+        reader.result()
+        for writer in writers:
+            writer.result()
+    return frame_count
+
+def main():
+    # Input parameters for file path and output directory
+    file_path = input("Enter the path to your file (image or video): ")
+    output_dir = input("Enter the output directory for the cropped images: ")
+
+    # Check and create default output directory if necessary
+    if not output_dir:
+        output_dir = "default_output"
+    os.makedirs(output_dir, exist_ok=True)
+
+    # Feature tags are only printed, so skip the landmark model unless asked for
+    detect_landmarks = input("Detect facial features for tags? (y/N): ").strip().lower().startswith('y')
+
+    if os.path.exists(file_path):
+        if file_path.lower().endswith(('.png', '.jpg', '.jpeg')):
+            image = cv2.imread(file_path)
+            if image is None:
+                print(f"Error: Image file '{file_path}' not found.")
+                return
+
+            rgb_image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+            face_locations = upscale_face_locations(face_recognition.face_locations(downscale_for_detection(rgb_image)))
+            feature_crop, feature_tags, entire_head_crop, head_tags = get_random_face_crop_and_tags(rgb_image, face_locations, detect_landmarks)
+
+            if feature_crop is not None and entire_head_crop is not None:
+                feature_file_path = os.path.join(output_dir, 'feature_crop.jpg')
+                head_file_path = os.path.join(output_dir, 'head_crop.jpg')
+
+                cv2.imwrite(feature_file_path, cv2.cvtColor(feature_crop, cv2.COLOR_RGB2BGR), JPEG_PARAMS)
+                cv2.imwrite(head_file_path, cv2.cvtColor(entire_head_crop, cv2.COLOR_RGB2BGR), JPEG_PARAMS)
+
+                print(f"Tags for feature crop: {feature_tags}")
+                print(f"Tags for head crop: {head_tags}")
+                print(f"Saved cropped images to {output_dir}")
+            else:
+                print("No face detected in the image.")
+        elif file_path.lower().endswith('.mov'):
+            fps = float(input(f"Enter frames per second to extract (default: {DEFAULT_FPS}): ") or DEFAULT_FPS)
+            extract_faces_from_video(file_path, output_dir, fps, detect_landmarks)
+    else:
+        print(f"Error: File '{file_path}' not found.")
+
+if __name__ == '__main__':
+    main()
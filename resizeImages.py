@@ -15,6 +15,10 @@ This software is released under the MIT License.
 ### Dependencies
 To run this program, you need to have Python installed on your system along with the following Python libraries:
 - Pillow (PIL Fork): This can be installed using pip with the command `pip install Pillow`
+  For faster resizing, Pillow-SIMD is a drop-in replacement with AVX2 resampling:
+  `pip uninstall pillow && CC="cc -mavx2" pip install pillow-simd`
+- onnxruntime (optional): only needed for `u2net` background removal, install with `pip install onnxruntime-gpu`
+  and place the `u2netp.onnx` model next to this script
 
 ### Usage
 1. Ensure Python and Pillow are installed.
@@ -23,55 +27,47 @@ To run this program, you need to have Python installed on your system along with
 4. Follow the prompts to specify the source and target directories for your images.
 '''
 
+import json
 import os
+import re
 import shutil
+from multiprocessing import Pool
 from PIL import Image, ExifTags
 import face_recognition
 import numpy as np
 import cv2
 
-def delete_hidden_files_and_directories(directory):
-    """
-    Recursively deletes hidden files and directories in the specified directory.
-    """
-    for root, dirs, files in os.walk(directory, topdown=False):
-        # Delete hidden files
-        for name in files:
-            if name.startswith('.'):
-                os.remove(os.path.join(root, name))
-
-        # Delete hidden directories
-        for name in dirs:
-            if name.startswith('.'):
-                shutil.rmtree(os.path.join(root, name))
-
-
-def is_valid_image(file_path):
-    try:
-        with Image.open(file_path) as img:
-            img.verify()  # Verify if it's an image
-        return True
-    except (IOError, SyntaxError):
-        return False
+try:
+    import onnxruntime
+except ImportError:
+    onnxruntime = None
+
+ALLOWED_EXTENSIONS = ('.png', '.jpeg', '.jpg', '.gif')  # Allowed source file extensions
+MANIFEST_NAME = 'manifest.json'  # Written to the top of the target directory, records what has been processed
+CAPTION_EXTENSIONS = ('.txt', '.caption')  # Captions written next to an output follow it when it is renumbered
+REMOVE_BG_METHODS = ('none', 'grabcut', 'u2net')
+BACKGROUND_COLOR = (255, 255, 255)  # Removed backgrounds are filled with this in formats without alpha
+U2NET_MODEL_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'u2netp.onnx')
+U2NET_INPUT_SIZE = 320
+REDUCE_MODES = ('L', 'LA', 'La', 'RGB', 'RGBA', 'RGBa', 'RGBX', 'CMYK', 'YCbCr', 'I', 'F')  # Modes Image.reduce supports
+
+# EXIF orientation tag id, looked up once rather than per image
+ORIENTATION_TAG = next(tag for tag, name in ExifTags.TAGS.items() if name == 'Orientation')
+EXIF_ORIENTATION_TRANSPOSE = {
+    3: Image.Transpose.ROTATE_180,
+    6: Image.Transpose.ROTATE_270,
+    8: Image.Transpose.ROTATE_90,
+}
+
+# Loaded once per process on first use, and reused for every image; process_images runs
+# u2net in a single worker process so the model is loaded once per run
+_u2net_session = None
 
 def correct_orientation(img):
-    # Correct orientation using EXIF data
-    try:
-        for orientation in ExifTags.TAGS.keys():
-            if ExifTags.TAGS[orientation] == 'Orientation':
-                break
-
-        exif = dict(img._getexif().items())
-
-        if exif[orientation] == 3:
-            img = img.rotate(180, expand=True)
-        elif exif[orientation] == 6:
-            img = img.rotate(270, expand=True)
-        elif exif[orientation] == 8:
-            img = img.rotate(90, expand=True)
-    except (AttributeError, KeyError, IndexError):
-        # Cases: image doesn't have getexif
-        pass
+    # Correct orientation using EXIF data, with lossless transposes instead of resampling rotates
+    transpose = EXIF_ORIENTATION_TRANSPOSE.get(img.getexif().get(ORIENTATION_TAG, 1))
+    if transpose is not None:
+        img = img.transpose(transpose)
 
     return img
 
@@ -91,8 +87,14 @@ def make_square_and_resize(img, size):
     # Crop or pad to make the image square
     img = img.crop((left, top, right, bottom))
 
+    # Box-reduce by an integer factor first, so the final filter only sees about twice the target size.
+    # Image.reduce rejects palette, bilevel and 16-bit modes, which are left to thumbnail alone
+    factor = short_side // (size * 2)
+    if factor >= 2 and img.mode in REDUCE_MODES:
+        img = img.reduce(factor)
+
     # Resize image
-    img.thumbnail((size, size))
+    img.thumbnail((size, size), Image.Resampling.LANCZOS)
 
     return img
 
@@ -124,13 +126,13 @@ def analyze_feature_shape_and_size(feature_points):
     size_description = "size cannot be determined without context"  # Placeholder
     return shape_description, size_description
 
-def remove_background_using_grabcut(input_path):
+def remove_background_using_grabcut(img):
     """
     Use OpenCV's grabCut algorithm to remove the background from an image.
     This function returns an image with a transparent background.
     """
-    # Load the image
-    img = cv2.imread(input_path)
+    # grabCut works on any 3-channel 8-bit array, so keep PIL's RGB order throughout
+    img = np.array(img.convert('RGB'))
     mask = np.zeros(img.shape[:2], np.uint8)
 
     # Define the rectangle area to assume the foreground
@@ -146,26 +148,81 @@ def remove_background_using_grabcut(input_path):
     img = img * mask2[:, :, np.newaxis]
 
     # Convert the image to have a transparent background
-    tmp = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+    tmp = cv2.cvtColor(img, cv2.COLOR_RGB2GRAY)
     _, alpha = cv2.threshold(tmp, 0, 255, cv2.THRESH_BINARY)
-    b, g, r = cv2.split(img)
-    rgba = [b, g, r, alpha]
-    dst = cv2.merge(rgba, 4)
-    
+    dst = cv2.cvtColor(img, cv2.COLOR_RGB2RGBA)
+    dst[:, :, 3] = alpha
+
     return Image.fromarray(dst)
 
-def process_image(lora_name, class_name, input_path, output_path, output_format, size):
+def get_u2net_session():
+    """Returns the module-level U²-Net ONNX session, creating it on first use."""
+    global _u2net_session
+    if _u2net_session is None:
+        if onnxruntime is None:
+            raise ImportError("u2net background removal requires onnxruntime: pip install onnxruntime-gpu")
+        _u2net_session = onnxruntime.InferenceSession(
+            U2NET_MODEL_PATH, providers=["CUDAExecutionProvider", "CPUExecutionProvider"])
+    return _u2net_session
+
+def remove_background_using_u2net(img):
     """
-    Process the image: correct orientation, make square, resize, make background transparent, and save.
+    Use the U²-Net salient object detection model to remove the background from an image.
+    This function returns an image with a transparent background.
+    """
+    img = img.convert('RGB')
+    session = get_u2net_session()
+
+    # Normalize a 320x320 copy with the ImageNet mean and std, matching U²-Net's training preprocessing
+    small = np.asarray(img.resize((U2NET_INPUT_SIZE, U2NET_INPUT_SIZE), Image.BILINEAR), dtype=np.float32) / 255.0
+    small = (small - (0.485, 0.456, 0.406)) / (0.229, 0.224, 0.225)
+    tensor = small.transpose(2, 0, 1)[np.newaxis].astype(np.float32)
+
+    prediction = session.run(None, {session.get_inputs()[0].name: tensor})[0][0, 0]
+    prediction = (prediction - prediction.min()) / (prediction.max() - prediction.min() + 1e-8)
+
+    # Upscale the mask to the original size and use it as the alpha channel
+    alpha = Image.fromarray((prediction * 255).astype(np.uint8)).resize(img.size, Image.BILINEAR)
+    img.putalpha(alpha)
+    return img
+
+def remove_background(img, remove_bg):
+    """Removes the background with the chosen method, one of REMOVE_BG_METHODS."""
+    if remove_bg == 'grabcut':
+        return remove_background_using_grabcut(img)
+    if remove_bg == 'u2net':
+        return remove_background_using_u2net(img)
+    return img
+
+def flatten_alpha(img):
+    """Composites an image with transparency onto BACKGROUND_COLOR and returns it as RGB."""
+    if img.mode not in ('RGBA', 'LA', 'PA') and 'transparency' not in img.info:
+        return img.convert('RGB')
+    background = Image.new('RGBA', img.size, BACKGROUND_COLOR + (255,))
+    return Image.alpha_composite(background, img.convert('RGBA')).convert('RGB')
+
+def process_image(lora_name, class_name, input_path, output_path, output_format, size, remove_bg='none'):
+    """
+    Process the image: correct orientation, optionally make background transparent, make square, resize, and save.
     """
     try:
         with Image.open(input_path) as img:
-            img = remove_background_using_grabcut(input_path)
+            # For JPEGs, let libjpeg decode straight to the smallest 1/2, 1/4 or 1/8 scale
+            # that is still at least twice the target size
+            img.draft('RGB', (size * 2, size * 2))
             img = correct_orientation(img)
+            img = remove_background(img, remove_bg)
             img = make_square_and_resize(img, size)
-            img.save(output_path, format=output_format)
+            if output_format.upper() == 'JPEG':
+                # JPEG has no alpha channel, so composite rather than just dropping it, which would
+                # bring back the removed background; JPEG is also much cheaper to encode than PNG
+                flatten_alpha(img).save(output_path, format=output_format, quality=92, subsampling=2)
+            else:
+                img.save(output_path, format=output_format)
+        return True
     except IOError as e:
         print(f"Error processing image: {e}")
+        return False
     
 # def process_image(lora_name, class_name, input_path, output_path, output_format, size):
 #     """
@@ -179,72 +236,245 @@ def process_image(lora_name, class_name, input_path, output_path, output_format,
 #     except IOError as e:
 #         print(f"Error processing image: {e}")
 
-def count_files(directory, allowed_extensions):
-    """Counts the number of files in the specified directory with allowed extensions."""
-    return len([name for name in os.listdir(directory)
-                if os.path.isfile(os.path.join(directory, name)) and
-                os.path.splitext(name)[1] in allowed_extensions])
+def _worker(args):
+    """
+    Unpacks a (lora_name, class_name, input_path, output_path, output_format, size, remove_bg) tuple for Pool.
+    Returns (input_path, output_path, success) so the caller can update the manifest.
+    """
+    return args[2], args[3], process_image(*args)
 
-def process_images(lora_name, class_name, source_dir, target_dir, size, output_format):
-    if not os.path.exists(target_dir):
-        os.makedirs(target_dir)
-    else:
-        shutil.rmtree(target_dir)  # Clear out the output directory
-        os.makedirs(target_dir)
-    
-    # Delete hidden files and directories before processing the images
-    delete_hidden_files_and_directories(source_dir)
+def load_manifest(manifest_path):
+    """
+    Loads the manifest of a previous run: the names of its output tree and image directory, and
+    the key and output file name of every source image it processed.
+    """
+    try:
+        with open(manifest_path) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return {}
+
+def save_manifest(manifest_path, manifest):
+    with open(manifest_path, 'w') as f:
+        json.dump(manifest, f, indent=2)
 
-    allowed_extensions = ['.png', '.jpeg', '.jpg', '.gif']  # List of allowed file extensions
-    file_count = count_files(source_dir, allowed_extensions)
-    print(f'There are {file_count} files in the directory with allowed extensions.')
+def source_key(file_path, size, output_format, remove_bg):
+    """Identifies a version of a source file and the settings it is processed with."""
+    stat = os.stat(file_path)
+    return [stat.st_size, int(stat.st_mtime), size, output_format, remove_bg]
 
+def list_source_images(directory):
+    """
+    Lists the files in the specified directory with allowed extensions, deleting hidden files
+    and directories in the same scandir pass.
+    Files are not opened here; unreadable images are reported by process_image.
+    """
+    source_files = []
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            if entry.name.startswith('.'):
+                if entry.is_dir(follow_symlinks=False):
+                    shutil.rmtree(entry.path)
+                else:
+                    os.remove(entry.path)
+            elif entry.is_file() and entry.name.lower().endswith(ALLOWED_EXTENSIONS):
+                source_files.append(entry.path)
+    return source_files
+
+def reuse_previous_tree(target_dir, class_name, tree_name, image_dir_name, previous_tree, previous_image_dir):
+    """
+    Renames the output tree and image directory of a previous run when the file count or LoRA name,
+    and so their names, have changed, then deletes any other {count}_{class_name} trees and image
+    directories so Kohya only sees one copy of each image.
+    """
+    tree_path = os.path.join(target_dir, tree_name)
+    previous_path = os.path.join(target_dir, previous_tree) if previous_tree else None
+    if previous_path and previous_tree != tree_name and os.path.isdir(previous_path) and not os.path.exists(tree_path):
+        os.rename(previous_path, tree_path)
+
+    tree_pattern = re.compile(rf"\d+_{re.escape(class_name)}")
+    with os.scandir(target_dir) as entries:
+        for entry in entries:
+            if entry.name != tree_name and entry.is_dir(follow_symlinks=False) and tree_pattern.fullmatch(entry.name):
+                shutil.rmtree(entry.path)
+
+    image_root = os.path.join(tree_path, "dest", "img")
+    if not os.path.isdir(image_root):
+        return
+    image_dir = os.path.join(image_root, image_dir_name)
+    previous_image_path = os.path.join(image_root, previous_image_dir) if previous_image_dir else None
+    if previous_image_path and previous_image_dir != image_dir_name and os.path.isdir(previous_image_path) and not os.path.exists(image_dir):
+        os.rename(previous_image_path, image_dir)
+    with os.scandir(image_root) as entries:
+        for entry in entries:
+            if entry.name not in ('log', 'model', image_dir_name) and entry.is_dir(follow_symlinks=False):
+                shutil.rmtree(entry.path)
+
+def update_previous_outputs(image_dir, moves, kept_names):
+    """
+    Renames outputs and their captions whose sequence number changed, or that were just written
+    under a temporary name, then deletes every other previous output and caption so images removed
+    from the source directory, or that could not be processed, don't linger in the dataset.
+    """
+    # Move through temporary names first, as one output's new name can be another's old one
+    for old_name, new_name in moves:
+        os.replace(os.path.join(image_dir, old_name), os.path.join(image_dir, new_name + '.moving'))
+    for _, new_name in moves:
+        os.replace(os.path.join(image_dir, new_name + '.moving'), os.path.join(image_dir, new_name))
+
+    with os.scandir(image_dir) as entries:
+        for entry in entries:
+            if entry.is_file() and entry.name.startswith('image_') and entry.name not in kept_names:
+                os.remove(entry.path)
+
+def get_tree_names(class_name, lora_name, file_count):
+    """Names the output tree, e.g. 40_woman, and the image directory inside it, e.g. 40_woman m4rni."""
     factor = 3
-    multiplier = factor * file_count 
+    multiplier = factor * file_count
+    tree_name = f"{multiplier}_{class_name}"
+    return tree_name, f"{tree_name} {lora_name}"
+
+def process_images(lora_name, class_name, source_dir, target_dir, size, output_format, remove_bg='none', force=False):
+    if force:
+        shutil.rmtree(target_dir, ignore_errors=True)  # Clear out the output directory
+    os.makedirs(target_dir, exist_ok=True)
+
+    # Kept outside the trees named after the file count, so it survives images being added or removed
+    output_root = target_dir
+    manifest_path = os.path.join(output_root, MANIFEST_NAME)
+    previous_manifest = {} if force else load_manifest(manifest_path)
+    previous_images = previous_manifest.get('images', {})
+
+    # Sorted so sequence numbers, and therefore output names, are stable between runs
+    source_files = sorted(list_source_images(source_dir))
+    print(f'There are {len(source_files)} files in the directory with allowed extensions.')
+
+    # Files that could not be processed last time and haven't changed since are recorded with no
+    # output; skip them rather than retrying on every run, and leave them out of the count
+    keys = {file_path: source_key(file_path, size, output_format, remove_bg) for file_path in source_files}
+    images = {file_path: {'key': keys[file_path], 'output': None} for file_path in source_files
+              if previous_images.get(file_path) == {'key': keys[file_path], 'output': None}}
+    if images:
+        print(f'Skipping {len(images)} images that could not be processed last time')
+    file_count = len(source_files) - len(images)
+
+    tree_name, image_dir_name = get_tree_names(class_name, lora_name, file_count)
+    reuse_previous_tree(output_root, class_name, tree_name, image_dir_name,
+                        previous_manifest.get('tree'), previous_manifest.get('image_dir'))
     """40_woman"""
-    target_dir = os.path.join(target_dir, f"{multiplier}_{class_name}"); os.makedirs(target_dir)
+    target_dir = os.path.join(output_root, tree_name); os.makedirs(target_dir, exist_ok=True)
     """dest"""
-    target_dir = os.path.join(target_dir, "dest"); os.makedirs(target_dir)
+    target_dir = os.path.join(target_dir, "dest"); os.makedirs(target_dir, exist_ok=True)
     """40_woman/dest/img"""
-    target_dir = os.path.join(target_dir, "img"); os.makedirs(target_dir)
+    target_dir = os.path.join(target_dir, "img"); os.makedirs(target_dir, exist_ok=True)
     """40_woman/dest/log"""
-    os.makedirs(os.path.join(target_dir, "log"))
+    os.makedirs(os.path.join(target_dir, "log"), exist_ok=True)
     """40_woman/dest/model"""
-    os.makedirs(os.path.join(target_dir, "model"))
+    os.makedirs(os.path.join(target_dir, "model"), exist_ok=True)
     """40_woman/dest/40_woman m4rni"""
-    target_dir = os.path.join(target_dir, f"{multiplier}_{class_name} {lora_name}")
-    os.makedirs(target_dir)
+    target_dir = os.path.join(target_dir, image_dir_name)
+    os.makedirs(target_dir, exist_ok=True)
 
     # copy the images to this dir next and create the text file descriptions and move them there
     print(f'About to write {file_count} images to {target_dir}')
-    sequence_number = 1
-    for file_name in os.listdir(source_dir):
-        file_path = os.path.join(source_dir, file_name)
-        if is_valid_image(file_path):
-            output_file_name = f"image_{sequence_number}.{output_format.lower()}"
-            output_path = os.path.join(target_dir, output_file_name)
-            process_image(lora_name, class_name, file_path, output_path, output_format, size)
-            sequence_number += 1
-
-# Prompting user for input
-default_lora_name = 'M4rni'
-lora_name = input(f"Enter lora name (default: {default_lora_name}): ") or default_lora_name.lower()
-            
-default_class = 'Woman'
-class_name = input(f"Enter class name (default: {default_class}): ") or default_class.lower()
-
-default_source_dir = '/dataset/4va9/orig/'
-source_dir = input(f"Enter source directory (default: {default_source_dir}): ") or default_source_dir
-
-default_target_dir = '/dataset/4va9/output'
-target_dir = input(f"Enter target directory (default: {default_target_dir}): ") or default_target_dir
-
-image_size = int(input("Enter image size (default: 512, or something like 768): ") or 512)
-
-default_output_format = 'PNG'
-output_format = input(f"Enter output image format (default: {default_output_format}): ") or default_output_format
-
-process_images(lora_name, class_name, source_dir, default_target_dir, image_size, output_format)
-
-
-
+    to_process = []
+    for file_path in source_files:
+        if file_path in images:
+            continue
+        # Reuse outputs of files that are unchanged since they were last processed with the same settings
+        previous = previous_images.get(file_path)
+        if previous and previous['key'] == keys[file_path] and previous['output'] and os.path.exists(os.path.join(target_dir, previous['output'])):
+            images[file_path] = previous
+        else:
+            to_process.append(file_path)
+            if previous and previous['output']:
+                # Keep the previous entry until the file is reprocessed, so its captions are still
+                # found if this run is interrupted
+                images[file_path] = previous
+
+    # New outputs are written under temporary names and numbered once it is known which succeeded,
+    # so unreadable files don't leave gaps in the sequence
+    output_suffix = '.' + output_format.lower()
+    names_in_use = {entry['output'] for entry in images.values()}
+    args_list = []
+    pending_number = 0
+    for file_path in to_process:
+        pending_number += 1
+        while f"image_pending_{pending_number}{output_suffix}" in names_in_use:
+            pending_number += 1
+        output_path = os.path.join(target_dir, f"image_pending_{pending_number}{output_suffix}")
+        args_list.append((lora_name, class_name, file_path, output_path, output_format, size, remove_bg))
+
+    print(f'Skipping {file_count - len(args_list)} unchanged images')
+    try:
+        if args_list:
+            # Each process loads its own U²-Net session, so use a single one to keep a single GPU context
+            processes = 1 if remove_bg == 'u2net' else os.cpu_count()
+            with Pool(processes=processes) as pool:
+                for done, (input_path, output_path, success) in enumerate(pool.imap_unordered(_worker, args_list), start=1):
+                    output = os.path.basename(output_path) if success else None
+                    images[input_path] = {'key': keys[input_path], 'output': output}
+                    print(f'Processed {done}/{len(args_list)} images')
+
+        # Images that failed for the first time this run change the count, and so the tree name
+        outputs = [file_path for file_path in source_files if images.get(file_path, {}).get('output')]
+        final_tree_name, final_image_dir_name = get_tree_names(class_name, lora_name, len(outputs))
+        if final_tree_name != tree_name:
+            reuse_previous_tree(output_root, class_name, final_tree_name, final_image_dir_name, tree_name, image_dir_name)
+            tree_name, image_dir_name = final_tree_name, final_image_dir_name
+            target_dir = os.path.join(output_root, tree_name, "dest", "img", image_dir_name)
+
+        # Number the outputs in source order, so output names are stable between runs
+        moves = []
+        kept_names = set()
+        output_names = {}
+        for sequence_number, file_path in enumerate(outputs, start=1):
+            output_stem = f"image_{sequence_number}"
+            output_names[file_path] = output_stem + output_suffix
+            renames = [(images[file_path]['output'], output_names[file_path])]
+            previous = previous_images.get(file_path)
+            if previous and previous['output']:
+                # Captions are written by hand next to an output, so they follow its source to its new number
+                previous_stem = os.path.splitext(previous['output'])[0]
+                renames.extend((previous_stem + extension, output_stem + extension) for extension in CAPTION_EXTENSIONS
+                               if os.path.exists(os.path.join(target_dir, previous_stem + extension)))
+            moves.extend((old_name, new_name) for old_name, new_name in renames if old_name != new_name)
+            kept_names.update(new_name for _, new_name in renames)
+        update_previous_outputs(target_dir, moves, kept_names)
+        for file_path, output_name in output_names.items():
+            images[file_path] = {'key': keys[file_path], 'output': output_name}
+    finally:
+        # Record whatever completed, even if a worker failed part way through
+        save_manifest(manifest_path, {'tree': tree_name, 'image_dir': image_dir_name, 'images': images})
+
+def main():
+    # Prompting user for input
+    default_lora_name = 'M4rni'
+    lora_name = input(f"Enter lora name (default: {default_lora_name}): ") or default_lora_name.lower()
+
+    default_class = 'Woman'
+    class_name = input(f"Enter class name (default: {default_class}): ") or default_class.lower()
+
+    default_source_dir = '/dataset/4va9/orig/'
+    source_dir = input(f"Enter source directory (default: {default_source_dir}): ") or default_source_dir
+
+    default_target_dir = '/dataset/4va9/output'
+    target_dir = input(f"Enter target directory (default: {default_target_dir}): ") or default_target_dir
+
+    image_size = int(input("Enter image size (default: 512, or something like 768): ") or 512)
+
+    default_output_format = 'JPEG'
+    output_format = input(f"Enter output image format (default: {default_output_format}): ") or default_output_format
+
+    default_remove_bg = 'none'
+    remove_bg = input(f"Enter background removal method {REMOVE_BG_METHODS} (default: {default_remove_bg}): ") or default_remove_bg
+    if remove_bg not in REMOVE_BG_METHODS:
+        print(f"Unknown background removal method '{remove_bg}', using '{default_remove_bg}'.")
+        remove_bg = default_remove_bg
+
+    force = input("Reprocess all images, clearing the target directory? (y/N): ").strip().lower().startswith('y')
+
+    process_images(lora_name, class_name, source_dir, target_dir, image_size, output_format, remove_bg, force)
+
+if __name__ == '__main__':
+    main()